@@ -1,10 +1,16 @@
 import os
+import math
 import logging
+import tempfile
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 from PIL import Image
 import fitz  # PyMuPDF
+import numpy as np
 from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
 import asyncio
 
 # Enable logging
@@ -14,27 +20,31 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-class PDFBot:
-    def __init__(self, token):
-        self.token = token
-        self.application = Application.builder().token(token).build()
-        self.setup_handlers()
-    
-    def setup_handlers(self):
-        # Command handlers
-        self.application.add_handler(CommandHandler("start", self.start_command))
-        self.application.add_handler(CommandHandler("help", self.help_command))
-        
-        # Message handlers
-        self.application.add_handler(MessageHandler(filters.PHOTO, self.handle_photo))
-        self.application.add_handler(MessageHandler(filters.Document.PDF, self.handle_pdf))
-        
-        # Error handler
-        self.application.add_error_handler(self.error_handler)
-    
-    async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Send welcome message when command /start is issued."""
-        welcome_text = """
+# Rasterized pixel area per page when compressing, chosen so typical
+# documents land under the 240KB target on the first quality attempt
+TARGET_PIXELS = 1_000_000
+
+# Text-like pages (text, tables, blank pages) are almost all near-white
+# paper and near-black ink: fewer than TEXT_PAGE_MIDTONES of their pixels
+# are in between, while photos, even faded or low-contrast ones, are
+# mostly mid-tones. When a document mixing both misses the size target,
+# its text-like pages are capped at TEXT_PAGE_QUALITY so the photos keep
+# more of the budget
+TEXT_PAGE_MIDTONES = 0.25
+TEXT_PAGE_QUALITY = 30
+
+# Rendered pixmaps are kept for the quality retries only while their total
+# size stays under this budget; pages past it are re-rendered per attempt
+PIXMAP_CACHE_BYTES = 64 * 1024 * 1024
+
+# Each worker process costs about 65MB idle, plus up to PIXMAP_CACHE_BYTES
+# and the parsed document while it works, so the pool stays small. Workers
+# are replaced after WORKER_MAX_TASKS jobs so fragmentation doesn't build up
+MAX_WORKERS = 2
+WORKER_MAX_TASKS = 50
+
+# Command replies are constant, so they are built once at import
+WELCOME_TEXT = """
 🤖 **PDF Converter Bot** 🤖
 
 मैं आपकी images को PDF में और PDF files को compress करने में मदद करता हूं!
@@ -49,12 +59,9 @@ class PDFBot:
 2. PDF file भेजें - मैं उसे compress कर दूंगा
 
 **Note:** सभी PDF files 240KB से कम size की होंगी।
-        """
-        await update.message.reply_text(welcome_text, parse_mode='Markdown')
-    
-    async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Send help message when command /help is issued."""
-        help_text = """
+""".strip()
+
+HELP_TEXT = """
 🆘 **Help Guide** 🆘
 
 **Commands:**
@@ -71,8 +78,276 @@ class PDFBot:
 2. Send PDF → Get compressed PDF
 
 **Support:** अगर कोई problem हो तो developer से contact करें。
-        """
-        await update.message.reply_text(help_text, parse_mode='Markdown')
+""".strip()
+
+# CPU-bound conversion work. These run in the bot's worker processes, so
+# they are module-level functions that only take and return plain bytes.
+
+def _images_to_pdf_sync(image_bytes_list):
+    """Blocking implementation of PDFBot.images_to_pdf."""
+    if not image_bytes_list:
+        return b''  # PyMuPDF cannot save a document without pages
+    
+    doc = fitz.open()
+    
+    for img_bytes in image_bytes_list:
+        if img_bytes[:3] == b'\xff\xd8\xff':
+            # JPEG: embed the original bytes, only the header is read
+            width, height = Image.open(BytesIO(img_bytes)).size
+            page = doc.new_page(width=width, height=height)
+            page.insert_image(page.rect, stream=img_bytes)
+        else:
+            # Other formats: decode once and embed the pixmap
+            try:
+                pix = fitz.Pixmap(img_bytes)
+            except RuntimeError:
+                # Formats MuPDF can't decode (e.g. WebP) go through PIL
+                img = Image.open(BytesIO(img_bytes)).convert('RGB')
+                pix = fitz.Pixmap(fitz.csRGB, img.width, img.height, img.tobytes(), False)
+            page = doc.new_page(width=pix.width, height=pix.height)
+            page.insert_image(page.rect, pixmap=pix)
+    
+    pdf_bytes = doc.tobytes(garbage=4, deflate=True)
+    doc.close()
+    
+    return pdf_bytes
+
+def _compress_sync(pdf, target_kb):
+    """Blocking implementation of PDFBot.compress_pdf_to_target_size.
+    
+    pdf is either the PDF's bytes or the path of a PDF file. A path lets
+    PyMuPDF read the file from disk instead of the bytes being pickled
+    over to the worker process.
+    """
+    from_file = isinstance(pdf, str)
+    try:
+        original_size = os.path.getsize(pdf) if from_file else len(pdf)
+        
+        if original_size / 1024 <= target_kb:
+            return _read_pdf(pdf)  # Already under target size
+        
+        with (fitz.open(pdf) if from_file else fitz.open(stream=pdf, filetype="pdf")) as doc:
+            compressed_bytes = _search_quality(doc, original_size, target_kb)
+        
+        # Keep the original if no attempt came out smaller
+        return compressed_bytes if compressed_bytes is not None else _read_pdf(pdf)
+        
+    except Exception as e:
+        logger.error(f"Error in compress_pdf: {e}")
+        return _read_pdf(pdf)  # Return original if compression fails
+
+def _read_pdf(pdf):
+    """Return the bytes of pdf, given as bytes or a file path."""
+    if isinstance(pdf, str):
+        with open(pdf, 'rb') as f:
+            return f.read()
+    return pdf
+
+def _search_quality(doc, original_size, target_kb):
+    """Find the highest JPEG quality that brings doc under target_kb.
+    
+    Returns None when no attempt is smaller than original_size bytes.
+    """
+    # Rasterize every page once; retries only re-encode the JPEGs. Pages
+    # are rendered serially on purpose: parallelism comes from running
+    # separate requests in separate workers, and splitting one document
+    # across the small pool would make other users wait behind it
+    pages = _render_pages(doc)
+    
+    # Compression parameters
+    quality = 80  # Initial quality
+    low, high = 20, quality  # Quality search bounds
+    best_bytes = None  # Highest-quality result under target
+    smallest_bytes = None  # Fallback if nothing fits
+    smallest_size = original_size
+    
+    prev_size = None  # Size of the previous oversized attempt
+    text_cap = None  # Quality cap for text-like pages, once one is needed
+    
+    for attempt in range(3):  # Bounds worst-case work per request
+        compressed_bytes, text_share = _build_jpeg_pdf(doc, pages, quality, text_cap)
+        current_size = len(compressed_bytes) / 1024
+        
+        if len(compressed_bytes) < smallest_size:
+            smallest_bytes, smallest_size = compressed_bytes, len(compressed_bytes)
+        
+        if current_size <= target_kb:
+            best_bytes = compressed_bytes
+            low = quality + 1
+        else:
+            # Less than 5% smaller than the last miss: lowering
+            # quality further won't help, resolution has to drop
+            if prev_size is not None and prev_size - current_size < 0.05 * prev_size:
+                break
+            prev_size = current_size
+            if text_cap is None and 0 < text_share < 1:
+                # Mixed document: cap its text-like pages from now on.
+                # That makes this same quality smaller, so it stays a
+                # candidate
+                text_cap = TEXT_PAGE_QUALITY
+            else:
+                high = quality - 1
+        
+        if low > high:
+            break
+        
+        if attempt == 0:
+            # JPEG size scales roughly linearly with quality, so
+            # estimate the quality that lands on target directly
+            estimate = quality * target_kb / current_size
+            if text_cap is not None and estimate > text_cap:
+                # Capped text-like pages stop following quality, so only
+                # the rest of the document is scaled
+                text_kb = current_size * text_share
+                capped_text_kb = text_kb * text_cap / quality
+                estimate = quality * (target_kb - capped_text_kb) / (current_size - text_kb)
+            quality = max(low, min(high, int(estimate)))
+        else:
+            quality = (low + high) // 2
+    
+    if best_bytes is None:
+        # Last resort: halve the resolution of every page, once
+        for _, _, pix, _ in pages:
+            if pix is not None:
+                pix.shrink(1)
+        compressed_bytes, _ = _build_jpeg_pdf(doc, pages, max(20, min(quality, high)), text_cap, shrink=1)
+        if len(compressed_bytes) < smallest_size:
+            smallest_bytes = compressed_bytes
+    
+    return best_bytes if best_bytes is not None else smallest_bytes
+
+def _render_pages(doc):
+    """Rasterize every page of doc for the quality search.
+    
+    Returns (page_num, rect, pixmap, text_like) tuples. pixmap is None for
+    pages rendered after the PIXMAP_CACHE_BYTES budget ran out; those
+    are rendered again by _build_jpeg_pdf on every attempt.
+    """
+    pages = []
+    cached_bytes = 0
+    for page_num in range(len(doc)):
+        page = doc[page_num]
+        pix, text_like = _render_page(page)
+        pix_bytes = pix.stride * pix.height
+        if cached_bytes + pix_bytes <= PIXMAP_CACHE_BYTES:
+            cached_bytes += pix_bytes
+        else:
+            pix = None
+        pages.append((page_num, page.rect, pix, text_like))
+    return pages
+
+def _render_page(page):
+    """Rasterize one page, returning (pixmap, text_like)."""
+    # Scale so the bitmap is about TARGET_PIXELS, never upscaling
+    area = page.rect.width * page.rect.height
+    scale = min(math.sqrt(TARGET_PIXELS / area), 1.0) if area else 1.0
+    pix = page.get_pixmap(matrix=fitz.Matrix(scale, scale))
+    grayscale, text_like = _analyze_pixmap(pix)
+    if grayscale:
+        pix = fitz.Pixmap(fitz.csGRAY, pix)  # Single-channel JPEG
+    return pix, text_like
+
+def _analyze_pixmap(pix):
+    """Return (grayscale, text_like) for a pixmap.
+    
+    grayscale is True when every pixel has R == G == B, text_like when
+    fewer than TEXT_PAGE_MIDTONES of the pixels are neither near-white
+    nor near-black.
+    """
+    a = np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(-1, pix.n)
+    grayscale = (
+        pix.n >= 3
+        and np.array_equal(a[:, 0], a[:, 1])
+        and np.array_equal(a[:, 1], a[:, 2])
+    )
+    channels = a[:, :1] if grayscale else a
+    midtones = (channels.min(axis=1) < 224) & (channels.max(axis=1) > 32)
+    text_like = np.count_nonzero(midtones) < TEXT_PAGE_MIDTONES * len(a)
+    return grayscale, text_like
+
+def _build_jpeg_pdf(doc, pages, quality, text_cap=None, shrink=0):
+    """Build a PDF with one JPEG page per rendered page of doc.
+    
+    Text-like pages are encoded at no more than text_cap, if given.
+    Returns the PDF bytes and the share of the JPEG bytes that came from
+    text-like pages.
+    """
+    text_bytes = image_bytes = 0
+    new_doc = fitz.open()
+    
+    for page_num, rect, pix, text_like in pages:
+        if pix is None:
+            # Over the cache budget: render again, one page at a time
+            pix, _ = _render_page(doc[page_num])
+            if shrink:
+                pix.shrink(shrink)
+        page_quality = min(quality, text_cap) if text_like and text_cap else quality
+        img_bytes = _encode_jpeg(pix, page_quality)
+        image_bytes += len(img_bytes)
+        if text_like:
+            text_bytes += len(img_bytes)
+        
+        # Create new page with compressed image
+        new_page = new_doc.new_page(width=rect.width, height=rect.height)
+        new_page.insert_image(rect, stream=img_bytes)
+    
+    compressed_bytes = new_doc.tobytes(garbage=4, deflate=True, clean=True)
+    new_doc.close()
+    
+    return compressed_bytes, text_bytes / image_bytes if image_bytes else 0
+
+def _encode_jpeg(pix, quality):
+    """Encode a pixmap as a progressive JPEG with optimized Huffman tables."""
+    # Same as pix.pil_tobytes, but wraps samples_mv instead of copying
+    # pix.samples and then copying again in Image.frombytes
+    mode = "L" if pix.n == 1 else "RGB"
+    img = Image.frombuffer(mode, (pix.width, pix.height), pix.samples_mv, "raw", mode, pix.stride, 1)
+    output = BytesIO()
+    img.save(output, format='JPEG', quality=quality, optimize=True, progressive=True)
+    return output.getvalue()
+
+class PDFBot:
+    def __init__(self, token):
+        self.token = token
+        self.application = Application.builder().token(token).build()
+        self.cpu_executor = self.create_executor()
+        self.setup_handlers()
+    
+    def create_executor(self):
+        """Create the worker process pool for CPU-bound PIL/PyMuPDF work."""
+        # One worker per usable core, up to MAX_WORKERS. PyMuPDF holds the
+        # GIL and is not thread-safe, so threads would still block the
+        # event loop. Spawned rather than forked, so the workers don't
+        # inherit the running Application.
+        if hasattr(os, 'sched_getaffinity'):
+            cores = len(os.sched_getaffinity(0))
+        else:
+            cores = os.cpu_count() or 1
+        return ProcessPoolExecutor(
+            max_workers=min(cores, MAX_WORKERS),
+            mp_context=multiprocessing.get_context('spawn'),
+            max_tasks_per_child=WORKER_MAX_TASKS
+        )
+    
+    def setup_handlers(self):
+        # Command handlers
+        self.application.add_handler(CommandHandler("start", self.start_command))
+        self.application.add_handler(CommandHandler("help", self.help_command))
+        
+        # Message handlers
+        self.application.add_handler(MessageHandler(filters.PHOTO, self.handle_photo))
+        self.application.add_handler(MessageHandler(filters.Document.PDF, self.handle_pdf))
+        
+        # Error handler
+        self.application.add_error_handler(self.error_handler)
+    
+    async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Send welcome message when command /start is issued."""
+        await update.message.reply_text(WELCOME_TEXT, parse_mode='Markdown')
+    
+    async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Send help message when command /help is issued."""
+        await update.message.reply_text(HELP_TEXT, parse_mode='Markdown')
     
     async def handle_photo(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Convert photos to PDF."""
@@ -125,12 +400,23 @@ class PDFBot:
                 await message.edit_text("❌ File size too large! Maximum 10MB allowed.")
                 return
             
-            # Download PDF
-            pdf_file = await document.get_file()
-            pdf_bytes = await pdf_file.download_as_bytearray()
+            if document.file_size and document.file_size <= 240 * 1024:
+                # Already under target, resend by file_id without downloading
+                await update.message.reply_document(
+                    document=document.file_id,
+                    caption="Your PDF is already under 240KB! 📄"
+                )
+                await message.delete()
+                return
             
-            # Compress PDF to under 240KB
-            compressed_pdf = await self.compress_pdf_to_target_size(pdf_bytes, 240)
+            # Download PDF to disk; the worker process opens it from there
+            # instead of the whole file being copied over to it
+            pdf_file = await document.get_file()
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                pdf_path = await pdf_file.download_to_drive(os.path.join(tmp_dir, "input.pdf"))
+                
+                # Compress PDF to under 240KB
+                compressed_pdf = await self.compress_pdf_to_target_size(str(pdf_path), 240)
             
             await message.edit_text("✅ PDF compressed! Sending...")
             
@@ -147,80 +433,29 @@ class PDFBot:
             logger.error(f"Error in handle_pdf: {e}")
             await update.message.reply_text("❌ Error processing PDF. Please try again.")
     
+    async def run_cpu_bound(self, func, *args):
+        """Run blocking CPU-bound work in the bot's worker processes."""
+        loop = asyncio.get_running_loop()
+        executor = self.cpu_executor
+        try:
+            return await loop.run_in_executor(executor, func, *args)
+        except BrokenProcessPool:
+            # A worker died (OOM kill, MuPDF crash) and the pool refuses all
+            # further work. Replace it so later requests still convert;
+            # only the requests that were running in it fail.
+            if self.cpu_executor is executor:
+                logger.error("Worker process died, restarting the pool")
+                executor.shutdown(wait=False, cancel_futures=True)
+                self.cpu_executor = self.create_executor()
+            raise
+    
     async def images_to_pdf(self, image_bytes_list):
         """Convert list of image bytes to PDF bytes."""
-        pdf_bytes = BytesIO()
-        
-        # Create PDF from images
-        images = []
-        for img_bytes in image_bytes_list:
-            img = Image.open(BytesIO(img_bytes))
-            if img.mode != 'RGB':
-                img = img.convert('RGB')
-            images.append(img)
-        
-        # Save first image and append others
-        if images:
-            images[0].save(
-                pdf_bytes,
-                format='PDF',
-                save_all=True,
-                append_images=images[1:] if len(images) > 1 else []
-            )
-        
-        return pdf_bytes.getvalue()
+        return await self.run_cpu_bound(_images_to_pdf_sync, image_bytes_list)
     
-    async def compress_pdf_to_target_size(self, pdf_bytes, target_kb):
-        """Compress PDF to target size in KB."""
-        try:
-            current_size = len(pdf_bytes) / 1024  # Size in KB
-            
-            if current_size <= target_kb:
-                return pdf_bytes  # Already under target size
-            
-            # Open the PDF
-            doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-            
-            # Compression parameters
-            quality = 80  # Initial quality
-            
-            while current_size > target_kb and quality >= 20:
-                # Create new PDF with compression
-                output = BytesIO()
-                new_doc = fitz.open()
-                
-                for page_num in range(len(doc)):
-                    page = doc[page_num]
-                    pix = page.get_pixmap(matrix=fitz.Matrix(0.8, 0.8))  # Reduce resolution
-                    img_bytes = pix.tobytes("jpeg", quality / 100)
-                    
-                    # Create new page with compressed image
-                    new_page = new_doc.new_page(width=page.rect.width, height=page.rect.height)
-                    new_page.insert_image(page.rect, stream=img_bytes)
-                
-                new_doc.save(output, garbage=4, deflate=True, clean=True)
-                new_doc.close()
-                
-                compressed_bytes = output.getvalue()
-                current_size = len(compressed_bytes) / 1024
-                
-                # Reduce quality for next iteration if needed
-                if current_size > target_kb:
-                    quality -= 20
-                
-                # Update PDF bytes for next iteration
-                pdf_bytes = compressed_bytes
-                doc.close()
-                doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-            
-            final_bytes = pdf_bytes
-            doc.close()
-            
-            return final_bytes
-            
-        except Exception as e:
-            logger.error(f"Error in compress_pdf: {e}")
-            return pdf_bytes  # Return original if compression fails
+    async def compress_pdf_to_target_size(self, pdf, target_kb):
+        """Compress PDF (bytes or file path) to target size in KB."""
+        return await self.run_cpu_bound(_compress_sync, pdf, target_kb)
     
     async def error_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Log errors and send friendly message."""
@@ -233,7 +468,10 @@ class PDFBot:
     
     def run(self):
         """Start the bot."""
-        self.application.run_polling(allowed_updates=Update.ALL_TYPES)
+        try:
+            self.application.run_polling(allowed_updates=Update.ALL_TYPES)
+        finally:
+            self.cpu_executor.shutdown(wait=False, cancel_futures=True)
 
 # Main function
 def main():